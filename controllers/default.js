@@ -1,5 +1,10 @@
 const Pty = require('node-pty');
 const fs = require('fs');
+const net = require('net');
+const child_process = require('child_process');
+
+// Resident Python service that serves every terminal session (service.py)
+const SERVICE_SOCKET = process.env.HOLIDAY_SERVICE_SOCKET || '/tmp/holiday-booking.sock';
 
 exports.install = function () {
 
@@ -8,39 +13,94 @@ exports.install = function () {
 
 };
 
-function socket() {
+function startService() {
 
-    this.encodedecode = false;
-    this.autodestroy();
+    if (process.env.HOLIDAY_SERVICE === 'off') {
+        return;
+    }
 
-    this.on('open', function (client) {
+    const service = child_process.spawn('python3', ['service.py'], {
+        cwd: process.env.PWD,
+        env: process.env,
+        stdio: 'inherit'
+    });
+
+    service.on('exit', function (code, signal) {
+        console.log("Booking service stopped, sessions will use run.py");
+    });
+}
+
+function spawnTerminal(client) {
+
+    // Fallback when the service is not running: one run.py per session
+    client.tty = Pty.spawn('python3', ['run.py'], {
+        name: 'xterm-color',
+        cols: 80,
+        rows: 24,
+        cwd: process.env.PWD,
+        env: process.env
+    });
+
+    client.tty.on('exit', function (code, signal) {
+        client.tty = null;
+        client.close();
+        console.log("Process killed");
+    });
+
+    client.tty.on('data', function (data) {
+        client.send(data);
+    });
+}
 
-        // Spawn terminal
-        client.tty = Pty.spawn('python3', ['run.py'], {
-            name: 'xterm-color',
-            cols: 80,
-            rows: 24,
-            cwd: process.env.PWD,
-            env: process.env
-        });
+function attachSession(client) {
 
-        client.tty.on('exit', function (code, signal) {
+    const session = net.createConnection(SERVICE_SOCKET);
+    let connected = false;
+    session.setEncoding('utf8');
+
+    session.on('connect', function () {
+        connected = true;
+        client.tty = session;
+    });
+
+    session.on('data', function (data) {
+        client.send(data);
+    });
+
+    session.on('error', function (err) {
+        if (!connected) {
+            spawnTerminal(client);
+        }
+    });
+
+    session.on('close', function () {
+        if (connected) {
             client.tty = null;
             client.close();
-            console.log("Process killed");
-        });
+            console.log("Session closed");
+        }
+    });
+}
+
+function socket() {
 
-        client.tty.on('data', function (data) {
-            client.send(data);
-        });
+    this.encodedecode = false;
+    this.autodestroy();
 
+    this.on('open', function (client) {
+        attachSession(client);
     });
 
     this.on('close', function (client) {
         if (client.tty) {
-            client.tty.kill(9);
+            if (client.tty.kill) {
+                client.tty.kill(9);
+                console.log("Process killed and terminal unloaded");
+            } else {
+                client.tty.destroy();
+                console.log("Session detached");
+            }
             client.tty = null;
-            console.log("Process killed and terminal unloaded");
         }
     });
 
@@ -55,6 +115,10 @@ if (process.env.CREDS != null) {
         if (err) {
             console.log('Error writing file: ', err);
             socket.emit("console_output", "Error saving credentials: " + err);
+            return;
         }
+        startService();
     });
-}
\ No newline at end of file
+} else {
+    startService();
+}
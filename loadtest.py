@@ -0,0 +1,665 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from gspread.cell import Cell
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+from gspread.utils import a1_range_to_grid_range
+from requests import Response
+
+import run
+from rules import ShiftCapRule
+from request_queue import DEFAULT_WINDOW, LeaveRequestQueue
+from sites import RateLimitedHTTPClient, Site, use_site
+
+# Default share of each kind of request; 'invalid' applies with a wrong shift
+DEFAULT_MIX = {"apply": 0.7, "cancel": 0.2, "invalid": 0.1}
+
+HEADER = ["Employee Names", "Employee shifts", "Total Leave", "Leave Taken",
+          ""]
+FIRST_DATE_COL = len(HEADER) + 1
+LEAVE_TAKEN_COL = 4
+
+
+class MemorySpreadsheet:
+    """
+    Spreadsheet holding the in-memory worksheets, with a freshness probe
+    that changes on every write like Drive's modifiedTime.
+    """
+
+    id = "loadtest"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_lastUpdateTime(self):
+        return self.backend.call(lambda: str(self.backend.version))
+
+
+class MemoryTransport(HTTPClient):
+    """
+    Bottom layer of the load test's HTTP client: instead of sending a
+    request, it answers it from the in-memory backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def request(self, method, endpoint, operation=None, **kwargs):
+        return self.backend.respond(operation)
+
+
+class MemoryHTTPClient(RateLimitedHTTPClient, MemoryTransport):
+    """
+    The app's own HTTP client from sites.py, with its rate limiting and
+    429 backoff, sending its requests to the in-memory backend.
+    """
+
+
+def too_many_requests():
+    """
+    Builds the APIError gspread raises when the Sheets API answers 429.
+    """
+    response = Response()
+    response.status_code = 429
+    response._content = json.dumps({"error": {
+        "code": 429,
+        "message": "Quota exceeded for quota metric 'Read requests'",
+        "status": "RESOURCE_EXHAUSTED",
+    }}).encode()
+    return APIError(response)
+
+
+class MemoryBackend:
+    """
+    Stands in for the Sheets API: every call waits for a simulated
+    latency and may be answered with a 429. Calls go through the same
+    HTTP client class as the app, so 429s are handled exactly as they
+    would be in production.
+    """
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.version = 0
+        self.calls = 0
+        self.throttled = 0
+        self.spreadsheet = MemorySpreadsheet(self)
+        self.client = MemoryHTTPClient(self)
+        self.lock = threading.RLock()
+        self._random = random.Random(seed)
+
+    def call(self, operation):
+        """
+        Sends one API call through the app's HTTP client.
+
+        Parameters:
+        - operation (callable): Reads or changes the in-memory data.
+
+        Returns:
+        - The result of the operation.
+
+        Raises:
+        - gspread.exceptions.APIError: If the call is still answered with
+        a 429 after the client's last retry.
+        """
+        return self.client.request("post", "memory", operation=operation)
+
+    def respond(self, operation):
+        """
+        Answers one request after the simulated latency, either with a
+        429 or by running the operation under the backend lock, so each
+        call is atomic like a Sheets request.
+        """
+        with self.lock:
+            self.calls += 1
+            delay = self.latency * self._random.uniform(0.5, 1.5)
+            throttled = self._random.random() < self.error_rate
+            if throttled:
+                self.throttled += 1
+        time.sleep(delay)
+        if throttled:
+            raise too_many_requests()
+        with self.lock:
+            return operation()
+
+
+class MemoryWorksheet:
+    """
+    In-memory worksheet with the part of the gspread.Worksheet interface
+    used by run.py, the roster cache and the range planner.
+
+    The 'Leave Taken' column is recalculated after every write, as the
+    formula in the real sheet would.
+    """
+
+    def __init__(self, backend, worksheet_id, values, leave_taken=False):
+        self.backend = backend
+        self.spreadsheet = backend.spreadsheet
+        self.id = worksheet_id
+        self.values = [list(row) for row in values]
+        self.leave_taken = leave_taken
+
+    def _write(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        row_values = self.values[row - 1]
+        while len(row_values) < col:
+            row_values.append("")
+        row_values[col - 1] = value
+        if self.leave_taken and row > 1:
+            row_values[LEAVE_TAKEN_COL - 1] = str(
+                row_values[FIRST_DATE_COL - 1:].count("Leave"))
+        self.backend.version += 1
+
+    def _block(self, a1_range):
+        grid_range = a1_range_to_grid_range(a1_range)
+        top = grid_range.get("startRowIndex", 0)
+        bottom = grid_range.get("endRowIndex", len(self.values))
+        left = grid_range.get("startColumnIndex", 0)
+        right = grid_range.get("endColumnIndex")
+        block = [trim(row[left:right]) for row in self.values[top:bottom]]
+        return trim(block, [])
+
+    def get_all_values(self):
+        return self.backend.call(
+            lambda: [list(row) for row in self.values])
+
+    def row_values(self, row):
+        return self.backend.call(lambda: trim(
+            self.values[row - 1] if row <= len(self.values) else []))
+
+    def col_values(self, col):
+        return self.backend.call(lambda: trim(
+            [row[col - 1] if len(row) >= col else ""
+             for row in self.values]))
+
+    def find(self, query):
+        def search():
+            for row, row_values in enumerate(self.values, start=1):
+                for col, value in enumerate(row_values, start=1):
+                    if value == query:
+                        return Cell(row, col, value)
+            return None
+        return self.backend.call(search)
+
+    def batch_get(self, ranges):
+        return self.backend.call(
+            lambda: [self._block(a1_range) for a1_range in ranges])
+
+    def update_cell(self, row, col, value):
+        return self.backend.call(lambda: self._write(row, col, value))
+
+    def batch_update(self, data):
+        def update():
+            for change in data:
+                grid_range = a1_range_to_grid_range(change["range"])
+                top = grid_range["startRowIndex"]
+                left = grid_range["startColumnIndex"]
+                for row_offset, row_values in enumerate(change["values"]):
+                    for col_offset, value in enumerate(row_values):
+                        self._write(top + row_offset + 1,
+                                    left + col_offset + 1, value)
+        return self.backend.call(update)
+
+    def append_row(self, values):
+        return self.append_rows([values])
+
+    def append_rows(self, values):
+        def append():
+            self.values.extend(list(row) for row in values)
+            self.backend.version += 1
+        return self.backend.call(append)
+
+
+class MemorySite(Site):
+    """
+    Site backed by in-memory worksheets instead of a Google spreadsheet.
+    """
+
+    def __init__(self, backend, holiday_values, snapshot):
+        super().__init__("loadtest", "loadtest", snapshot=snapshot)
+        self.backend = backend
+        self.holiday_sheet = MemoryWorksheet(
+            backend, 0, holiday_values, leave_taken=True)
+        self.audit_sheet = MemoryWorksheet(backend, 1, [[
+            "Timestamp", "Employee Name", "Action", "Start Date",
+            "End Date", "Status", "Remarks"]])
+
+    def open(self):
+        with self._lock:
+            if self._opened is None:
+                self._opened = {
+                    "holiday": self.holiday_sheet,
+                    "audit_trail": self.audit_sheet,
+                }
+            return self._opened
+
+
+def trim(values, empty=""):
+    """
+    Drops trailing empty values, as the Sheets API does.
+    """
+    values = list(values)
+    while values and values[-1] == empty:
+        values.pop()
+    return values
+
+
+def build_roster(year, employees_per_shift, total_leave=25):
+    """
+    Builds a 'holiday' worksheet for a whole year with no leave booked.
+
+    Parameters:
+    - year (int): Year covered by the date columns.
+    - employees_per_shift (int): Employees in each shift of rules.json.
+    - total_leave (int): Leave allowance of every employee.
+
+    Returns:
+    - tuple: The worksheet values and a dict of shift to employee names.
+    """
+    dates = []
+    current_date = datetime(year, 1, 1)
+    while current_date.year == year:
+        dates.append(current_date)
+        current_date += timedelta(days=1)
+
+    values = [HEADER + [date.strftime("%d %b") for date in dates]]
+    employees = {}
+    for shift in run.RULES.rotations:
+        employees[shift] = []
+        for number in range(1, employees_per_shift + 1):
+            employee_name = run.format_input(f"{shift} Employee {number}")
+            employees[shift].append(employee_name)
+            values.append(
+                [employee_name, shift, str(total_leave), "0", ""]
+                + ["In" if run.RULES.is_due(shift, date) else "Off"
+                   for date in dates])
+    return values, employees
+
+
+def parse_mix(text):
+    """
+    Parses a request mix such as 'apply=0.7,cancel=0.2,invalid=0.1'.
+
+    Returns:
+    - dict: Request kind to weight.
+
+    Raises:
+    - argparse.ArgumentTypeError: If a kind or weight is not valid.
+    """
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(
+                f"unknown request kind '{kind}'")
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"invalid weight for '{kind}': '{weight}'")
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("the mix needs a positive weight")
+    return mix
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the nearest-rank percentile of a sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def shift_cap_violations(values, employees):
+    """
+    Finds workdays where more employees of a shift are on leave than the
+    shift cap in rules.json allows.
+
+    Parameters:
+    - values (list): Final values of the 'holiday' worksheet.
+    - employees (dict): Shift to employee names.
+
+    Returns:
+    - list: (date label, shift, employees on leave, cap) tuples.
+    """
+    caps = [rule for rule in run.RULES.rules
+            if isinstance(rule, ShiftCapRule)]
+    shift_of = {name: shift for shift, names in employees.items()
+                for name in names}
+    violations = []
+    for col in range(FIRST_DATE_COL - 1, len(values[0])):
+        on_leave = Counter(
+            shift_of.get(row[0]) for row in values[1:]
+            if len(row) > col and row[col] == "Leave")
+        for shift, count in on_leave.items():
+            for rule in caps:
+                cap = rule.per_shift.get(shift, rule.max_on_leave)
+                if count > cap:
+                    violations.append((values[0][col], shift, count, cap))
+    return violations
+
+
+class LoadTest:
+    """
+    Drives run.apply_leave and run.cancel_leave from many simulated users
+    at once against an in-memory sheet, and records what happened.
+    """
+
+    def __init__(self, users=20, requests_per_user=10, mix=None,
+                 employees_per_shift=6, hot_shift=None, contention=0.5,
+                 window_days=14, max_days=4, think_time=0.0, latency=0.05,
+                 error_rate=0.0, queue_window=None, year=None,
+                 seed=None):
+        self.users = users
+        self.requests_per_user = requests_per_user
+        self.mix = mix or DEFAULT_MIX
+        self.contention = contention
+        self.window_days = window_days
+        self.max_days = max_days
+        self.think_time = think_time
+        self.queue_window = queue_window
+        self.year = year or datetime.now().year
+        self.seed = seed
+
+        values, self.employees = build_roster(self.year, employees_per_shift)
+        self.hot_shift = (run.format_input(hot_shift) if hot_shift
+                          else next(iter(self.employees)))
+        if self.hot_shift not in self.employees:
+            raise ValueError(f"Unknown shift: {hot_shift}")
+
+        self.backend = MemoryBackend(latency, error_rate, seed=seed)
+        self._snapshot_dir = tempfile.mkdtemp(prefix="holiday-loadtest-")
+        self.site = MemorySite(
+            self.backend, values,
+            os.path.join(self._snapshot_dir, "roster.snapshot"))
+        self.queue = None
+        if queue_window is not None:
+            self.queue = LeaveRequestQueue(run.process_leave_batch,
+                                           queue_window)
+        self.results = []
+        self._results_lock = threading.Lock()
+
+    def run_request(self, leave_action, employee_name, shift, start_date,
+                    end_date):
+        """
+        Runs one leave action the way a booking session does and returns
+        the audit rows it logged.
+        """
+        return run.run_leave_action(leave_action, employee_name, shift,
+                                    start_date, end_date)
+
+    def next_request(self, rng, booked):
+        """
+        Picks the next request of a simulated user.
+
+        Returns:
+        - tuple: (kind, employee name, shift, start date, end date).
+        """
+        kind = rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if kind == "cancel" and booked:
+            return (kind,) + booked.pop(rng.randrange(len(booked)))
+
+        if rng.random() < self.contention:
+            shift = self.hot_shift
+        else:
+            shift = rng.choice(list(self.employees))
+        employee_name = rng.choice(self.employees[shift])
+        if kind == "invalid":
+            shift = rng.choice([other for other in self.employees
+                                if other != shift] or [shift + " Shift"])
+
+        start = datetime(self.year, 1, 1) + timedelta(
+            days=rng.randrange(self.window_days))
+        end = min(start + timedelta(days=rng.randrange(self.max_days)),
+                  datetime(self.year, 12, 31))
+        return (kind, employee_name, shift, start.strftime("%Y-%m-%d"),
+                end.strftime("%Y-%m-%d"))
+
+    def simulate_user(self, user, start_barrier):
+        """
+        Sends one simulated user's requests one after another.
+        """
+        rng = random.Random(None if self.seed is None
+                            else f"{self.seed}-{user}")
+        booked = []
+        start_barrier.wait()
+        with use_site(self.site):
+            for _ in range(self.requests_per_user):
+                request = self.next_request(rng, booked)
+                kind = request[0]
+                leave_action = (run.cancel_leave if kind == "cancel"
+                                else run.apply_leave)
+                started = time.perf_counter()
+                try:
+                    if self.queue is not None:
+                        rows = self.queue.submit(
+                            "cancel" if kind == "cancel" else "apply",
+                            *request[1:]).result()
+                    else:
+                        rows = self.run_request(leave_action, *request[1:])
+                    error = None
+                except Exception as exception:
+                    rows, error = [], exception
+                elapsed = time.perf_counter() - started
+
+                outcome, remarks = outcome_of(rows, error)
+                if kind == "apply" and outcome == "Approved":
+                    booked.append(request[1:])
+                with self._results_lock:
+                    self.results.append((kind, outcome, remarks, elapsed))
+                if self.think_time:
+                    time.sleep(rng.uniform(0, 2 * self.think_time))
+
+    def run(self):
+        """
+        Loads the roster of the in-memory site, then runs every simulated
+        user at once.
+
+        Returns:
+        - dict: The measurements and the two-per-shift check.
+        """
+        with use_site(self.site):
+            self.site.roster.ensure_fresh()
+        calls_before = self.backend.calls
+        throttled_before = self.backend.throttled
+
+        start_barrier = threading.Barrier(self.users + 1)
+        threads = [threading.Thread(target=self.simulate_user,
+                                    args=(user, start_barrier))
+                   for user in range(self.users)]
+        # run.py reports every step with print(); keep the report readable
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            for thread in threads:
+                thread.start()
+            start_barrier.wait()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+        shutil.rmtree(self._snapshot_dir, ignore_errors=True)
+        final_values = [list(row) for row in self.site.holiday_sheet.values]
+        return {
+            "elapsed": elapsed,
+            "results": list(self.results),
+            "api_calls": self.backend.calls - calls_before,
+            "throttled": self.backend.throttled - throttled_before,
+            "violations": shift_cap_violations(final_values, self.employees),
+            "audit_rows": len(self.site.audit_sheet.values) - 1,
+        }
+
+
+def outcome_of(rows, error):
+    """
+    Classifies a request from the audit rows it logged.
+
+    Returns:
+    - tuple: Outcome ('Approved', 'Denied', 'No Change' or 'Error') and
+    the remarks of a denial or error.
+    """
+    if error is not None:
+        return "Error", type(error).__name__
+    if not rows:
+        return "No Change", ""
+    status, remarks = rows[-1][5], rows[-1][6]
+    if status == "Denied":
+        return "Denied", remarks
+    return status, ""
+
+
+def format_report(test, measurements):
+    """
+    Formats the load test results as a plain text report.
+
+    Parameters:
+    - test (LoadTest): The test that was run.
+    - measurements (dict): What LoadTest.run returned.
+
+    Returns:
+    - str: The report.
+    """
+    results = measurements["results"]
+    elapsed = measurements["elapsed"]
+    lines = [
+        f"Simulated users: {test.users} x {test.requests_per_user} requests"
+        + (f" (through the request queue, {test.queue_window:g}s window)"
+           if test.queue is not None else " (run directly, no locks)"),
+        "Request mix: " + ", ".join(
+            f"{kind}={weight:g}" for kind, weight in test.mix.items()),
+        f"Contention: {test.contention:.0%} of requests on the "
+        f"{test.hot_shift} shift, dates in the first {test.window_days} "
+        f"days of {test.year}",
+        f"Backend: {test.backend.latency * 1000:.0f} ms latency, "
+        f"{test.backend.error_rate:.1%} 429 errors",
+        "",
+        f"Requests: {len(results)} in {elapsed:.2f}s "
+        f"({len(results) / elapsed if elapsed else 0:.1f}/s)",
+        f"API calls: {measurements['api_calls']} "
+        f"({measurements['api_calls'] / max(len(results), 1):.1f} per "
+        f"request), {measurements['throttled']} answered with 429",
+        "",
+        f"{'Kind':<10}{'Count':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'Approved':>10}{'Denied':>8}{'No Change':>11}{'Error':>7}",
+    ]
+
+    by_kind = defaultdict(list)
+    for result in results:
+        by_kind[result[0]].append(result)
+    for kind, kind_results in list(by_kind.items()) + [("all", results)]:
+        latencies = sorted(result[3] for result in kind_results)
+        outcomes = Counter(result[1] for result in kind_results)
+        lines.append(
+            f"{kind:<10}{len(kind_results):>7}"
+            + "".join(f"{percentile(latencies, p) * 1000:>9.0f}"
+                      for p in (50, 95, 99))
+            + f"{outcomes['Approved']:>10}{outcomes['Denied']:>8}"
+            f"{outcomes['No Change']:>11}{outcomes['Error']:>7}")
+
+    denials = Counter()
+    for kind, outcome, remarks, _ in results:
+        if outcome in ("Denied", "Error"):
+            for remark in remarks.split("; "):
+                denials[remark] += 1
+    if denials:
+        lines += ["", "Denial and error reasons:"]
+        lines += [f"  {count:>6} ({count / len(results):.1%})  {remark}"
+                  for remark, count in denials.most_common()]
+
+    violations = measurements["violations"]
+    lines += ["", f"Two-per-shift violations: {len(violations)}"]
+    lines += [f"  {label}: {count} of the {shift} shift on leave "
+              f"(cap {cap})" for label, shift, count, cap in violations[:20]]
+    if len(violations) > 20:
+        lines.append(f"  ... and {len(violations) - 20} more")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line options of the load test.
+    """
+    parser = argparse.ArgumentParser(
+        description="Simulate many people booking leave at once against an "
+                    "in-memory copy of the holiday sheet.")
+    parser.add_argument("--users", type=int, default=20,
+                        help="concurrent simulated users (default 20)")
+    parser.add_argument("--requests", type=int, default=10,
+                        help="requests sent by each user (default 10)")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="request mix, e.g. "
+                             "'apply=0.7,cancel=0.2,invalid=0.1'")
+    parser.add_argument("--employees", type=int, default=6,
+                        help="employees in each shift (default 6)")
+    parser.add_argument("--hot-shift",
+                        help="shift most requests compete for "
+                             "(default is the first shift in rules.json)")
+    parser.add_argument("--contention", type=float, default=0.5,
+                        help="share of requests for the hot shift "
+                             "(default 0.5)")
+    parser.add_argument("--window", type=int, default=14,
+                        help="requests start within this many days of "
+                             "1 January (default 14)")
+    parser.add_argument("--max-days", type=int, default=4,
+                        help="longest request in days (default 4)")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="average pause between a user's requests, "
+                             "in seconds")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="average latency of each API call, in seconds "
+                             "(default 0.05)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of API calls answered with 429")
+    parser.add_argument("--queue", type=float, nargs="?",
+                        const=DEFAULT_WINDOW,
+                        metavar="SECONDS", dest="queue_window",
+                        help="run requests through the booking service's "
+                             "request queue, batching every SECONDS "
+                             "(default %(const)s)")
+    parser.add_argument("--year", type=int,
+                        help="year of the simulated sheet "
+                             "(default is this year)")
+    parser.add_argument("--seed", type=int,
+                        help="random seed, for repeatable runs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs the load test and prints its report.
+
+    Returns:
+    - int: 1 if the shift leave cap was exceeded, otherwise 0.
+    """
+    args = parse_args(argv)
+    test = LoadTest(
+        users=args.users, requests_per_user=args.requests, mix=args.mix,
+        employees_per_shift=args.employees, hot_shift=args.hot_shift,
+        contention=args.contention, window_days=args.window,
+        max_days=args.max_days, think_time=args.think_time,
+        latency=args.latency, error_rate=args.error_rate,
+        queue_window=args.queue_window, year=args.year,
+        seed=args.seed)
+    measurements = test.run()
+    print(format_report(test, measurements))
+    return 1 if measurements["violations"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
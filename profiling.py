@@ -0,0 +1,302 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from gspread.http_client import HTTPClient
+
+# Functions in run.py that make up the steps of apply_leave, cancel_leave,
+# batches of them and the leave report
+STEP_FUNCTIONS = [
+    "apply_leave",
+    "cancel_leave",
+    "validate_employee_and_shift",
+    "validate_shift",
+    "validate_leave_rules",
+    "process_leave_application",
+    "cache_date_columns",
+    "log_to_audit_trail",
+    "sheet_for_request",
+    "fetch_request_grid",
+    "process_leave_batch",
+    "fetch_batch_grid",
+    "leave_report",
+]
+
+DEFAULT_INTERVAL = 0.005  # Seconds between stack samples
+
+
+class StepStats:
+    """
+    Exclusive time spent in one step, split by where it went.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.network = 0.0
+        self.sleep = 0.0
+
+    @property
+    def other(self):
+        return max(self.wall - self.cpu - self.network - self.sleep, 0.0)
+
+
+class StepProfiler:
+    """
+    Attributes wall time, Python CPU, network wait and sleep/backoff to
+    the innermost step running on each thread, and samples the stack of
+    every thread that is running a step. Batches and reports for several
+    sites run on worker threads, so each thread keeps its own step stack.
+
+    Network wait is the wall time spent inside gspread's HTTPClient.request
+    minus the CPU used there (JSON encoding, TLS), and sleep is time spent
+    in time.sleep, which is where the app's HTTP client (sites.py) waits
+    for its rate limiter and before retrying a request.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stats = defaultdict(StepStats)
+        self.samples = Counter()
+        self._stacks = {}  # Thread id to that thread's running steps
+        self._lock = threading.Lock()
+        self._patches = []
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _stack(self):
+        return self._stacks.setdefault(threading.get_ident(), [])
+
+    def _enter(self, name):
+        stack = self._stack()
+        parent = stack[-1]["path"] if stack else ""
+        stack.append({
+            "path": f"{parent} > {name}" if parent else name,
+            "wall": time.perf_counter(),
+            "cpu": time.thread_time(),
+            "child_wall": 0.0,
+            "child_cpu": 0.0,
+        })
+
+    def _exit(self):
+        stack = self._stack()
+        frame = stack.pop()
+        wall = time.perf_counter() - frame["wall"]
+        cpu = time.thread_time() - frame["cpu"]
+        with self._lock:
+            stats = self.stats[frame["path"]]
+            stats.calls += 1
+            stats.wall += wall - frame["child_wall"]
+            stats.cpu += cpu - frame["child_cpu"]
+        if stack:
+            stack[-1]["child_wall"] += wall
+            stack[-1]["child_cpu"] += cpu
+
+    def _charge(self, field, seconds):
+        stack = self._stack()
+        if stack:
+            with self._lock:
+                stats = self.stats[stack[-1]["path"]]
+                setattr(stats, field, getattr(stats, field) + seconds)
+
+    def _wrap_step(self, name, func):
+        @functools.wraps(func)
+        def step(*args, **kwargs):
+            self._enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+        return step
+
+    def _wrap_request(self, request):
+        @functools.wraps(request)
+        def timed_request(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return request(*args, **kwargs)
+            finally:
+                self._charge("network", (time.perf_counter() - wall)
+                             - (time.thread_time() - cpu))
+        return timed_request
+
+    def _wrap_sleep(self, sleep):
+        @functools.wraps(sleep)
+        def timed_sleep(seconds):
+            start = time.perf_counter()
+            try:
+                return sleep(seconds)
+            finally:
+                self._charge("sleep", time.perf_counter() - start)
+        return timed_sleep
+
+    def _patch(self, owner, attribute, replacement):
+        self._patches.append((owner, attribute, getattr(owner, attribute)))
+        setattr(owner, attribute, replacement)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            busy = [thread_id for thread_id, steps
+                    in list(self._stacks.items()) if steps]
+            if not busy:
+                continue
+            frames = sys._current_frames()
+            for thread_id in busy:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    if code.co_filename == __file__:
+                        # Leave the profiler's own wrappers out of the stacks
+                        frame = frame.f_back
+                        continue
+                    module = os.path.splitext(
+                        os.path.basename(code.co_filename))[0]
+                    stack.append(f"{module}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def start(self, module):
+        """
+        Instruments the step functions of a module and starts sampling.
+
+        Parameters:
+        - module (module): The module holding the leave functions, which
+        is normally run.py itself.
+
+        Returns:
+        None
+        """
+        for name in STEP_FUNCTIONS:
+            func = getattr(module, name, None)
+            if callable(func):
+                self._patch(module, name, self._wrap_step(name, func))
+        self._patch(HTTPClient, "request",
+                    self._wrap_request(HTTPClient.request))
+        self._patch(time, "sleep", self._wrap_sleep(time.sleep))
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Stops sampling and restores everything that was instrumented.
+        """
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        while self._patches:
+            owner, attribute, original = self._patches.pop()
+            setattr(owner, attribute, original)
+
+    def format_steps(self):
+        """
+        Formats the per-step breakdown as a text table.
+
+        Returns:
+        - str: One line per step with calls and exclusive seconds split
+        into Python CPU, network wait, sleep/backoff and other.
+        """
+        width = max([len(path) for path in self.stats] + [4])
+        lines = [
+            f"{'step':<{width}} {'calls':>6} {'wall':>8} {'cpu':>8} "
+            f"{'network':>8} {'sleep':>8} {'other':>8}"
+        ]
+        for path, stats in sorted(self.stats.items()):
+            lines.append(
+                f"{path:<{width}} {stats.calls:>6} {stats.wall:>8.3f} "
+                f"{stats.cpu:>8.3f} {stats.network:>8.3f} "
+                f"{stats.sleep:>8.3f} {stats.other:>8.3f}"
+            )
+        return "\n".join(lines)
+
+    def format_top(self, top):
+        """
+        Formats the top functions by sampled self and inclusive time.
+
+        Parameters:
+        - top (int): Number of functions to list in each table.
+
+        Returns:
+        - str: The two tables as text.
+        """
+        total = sum(self.samples.values()) or 1
+        own, inclusive = Counter(), Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        lines = [f"Samples: {sum(self.samples.values())} "
+                 f"(every {self.interval * 1000:.1f} ms)", "",
+                 "Top functions by self time:"]
+        for frame, count in own.most_common(top):
+            lines.append(f"{count / total:>7.1%} {count:>6}  {frame}")
+        lines += ["", "Top functions by inclusive time:"]
+        for frame, count in inclusive.most_common(top):
+            lines.append(f"{count / total:>7.1%} {count:>6}  {frame}")
+        return "\n".join(lines)
+
+    def write_collapsed(self, path):
+        """
+        Writes the sampled stacks in the collapsed format read by
+        flamegraph.pl, speedscope and similar tools.
+        """
+        with open(path, "w") as collapsed_file:
+            for stack, count in sorted(self.samples.items()):
+                collapsed_file.write(f"{stack} {count}\n")
+
+
+def profile_call(func, module, out_dir="profile", top=25,
+                 deterministic=False, interval=DEFAULT_INTERVAL):
+    """
+    Runs a function under the step profiler and writes the reports.
+
+    Parameters:
+    - func (callable): The function to run, e.g. main.
+    - module (module): The module whose step functions are instrumented.
+    - out_dir (str): Directory for report.txt and collapsed.txt.
+    - top (int): Number of functions to list in the top-N tables.
+    - deterministic (bool): Also run cProfile and add its top-N table
+    (cProfile only sees the calling thread, not per-site workers).
+    - interval (float): Seconds between stack samples.
+
+    Returns:
+    - The return value of func.
+    """
+    profiler = StepProfiler(interval)
+    deterministic_profiler = cProfile.Profile() if deterministic else None
+    profiler.start(module)
+    if deterministic_profiler:
+        deterministic_profiler.enable()
+    try:
+        return func()
+    finally:
+        if deterministic_profiler:
+            deterministic_profiler.disable()
+        profiler.stop()
+
+        sections = ["Time per step (exclusive seconds)",
+                    profiler.format_steps(), "",
+                    profiler.format_top(top)]
+        if deterministic_profiler:
+            stream = io.StringIO()
+            pstats.Stats(deterministic_profiler, stream=stream) \
+                .sort_stats("cumulative").print_stats(top)
+            sections += ["", "cProfile (cumulative):", stream.getvalue()]
+
+        os.makedirs(out_dir, exist_ok=True)
+        report_path = os.path.join(out_dir, "report.txt")
+        collapsed_path = os.path.join(out_dir, "collapsed.txt")
+        with open(report_path, "w") as report_file:
+            report_file.write("\n".join(sections) + "\n")
+        profiler.write_collapsed(collapsed_path)
+        print(f"Profile written to {report_path} and {collapsed_path}")
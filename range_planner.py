@@ -0,0 +1,186 @@
+from datetime import timedelta
+
+from gspread.utils import a1_range_to_grid_range, rowcol_to_a1
+
+from roster_cache import LEAVE_TAKEN_COL, LocalGrid, build_header_index
+
+# The consecutive-leave check looks back this many days before the start
+LOOKBACK_DAYS = 8
+
+# Header row plus the employee name and shift columns
+INDEX_RANGES = ["1:1", "A:B"]
+
+
+class RequestGrid(LocalGrid):
+    """
+    LocalGrid holding only the cells planned for one request.
+
+    Cells outside the plan are unknown rather than empty, and the
+    validators index date columns by employee row, so columns are padded
+    to the full roster length instead of being trimmed.
+    """
+
+    def col_values(self, col):
+        column = super().col_values(col)
+        return column + [""] * (len(self.values) - len(column))
+
+
+def fetch_roster_index(worksheet):
+    """
+    Fetches the header row and the name/shift columns in one call.
+
+    Parameters:
+    - worksheet (gspread.Worksheet): The 'holiday' worksheet.
+
+    Returns:
+    - tuple: The header row as a list, and the rows of columns A:B
+    (including the header row) as a list of [name, shift] lists.
+    """
+    header_rows, directory_rows = worksheet.batch_get(INDEX_RANGES)
+    header = list(header_rows[0]) if header_rows else []
+    return header, [list(row) for row in directory_rows]
+
+
+def contiguous_runs(numbers):
+    """
+    Splits sorted numbers into (first, last) runs of consecutive values.
+
+    Parameters:
+    - numbers (list): Sorted, unique integers.
+
+    Returns:
+    - list: A (first, last) tuple for each run.
+    """
+    runs = []
+    for number in numbers:
+        if runs and number == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], number)
+        else:
+            runs.append((number, number))
+    return runs
+
+
+def plan_request_ranges(header_index, directory_rows, employee_name, shift,
+                        start_date_obj, end_date_obj,
+                        lookback_days=LOOKBACK_DAYS):
+    """
+    Computes the minimal A1 ranges one leave request needs to read.
+
+    These are the date columns from lookback_days before the start date
+    through the end date, for every employee in the requested shift plus
+    the requesting employee, and that employee's 'Leave Taken' cell.
+
+    Parameters:
+    - header_index (dict): Header label to column number.
+    - directory_rows (list): Rows of columns A:B, header row included.
+    - employee_name (str): Name of the employee making the request.
+    - shift (str): The shift given with the request.
+    - start_date_obj (datetime): Start date of the request.
+    - end_date_obj (datetime): End date of the request.
+    - lookback_days (int): Days before the start date to include.
+
+    Returns:
+    - list: A1 ranges, one per block of consecutive rows and columns,
+    plus the 'Leave Taken' cell.
+    """
+    date_cols = []
+    current_date = start_date_obj - timedelta(days=lookback_days)
+    while current_date <= end_date_obj:
+        date_col = header_index.get(current_date.strftime("%d %b"))
+        # The sheet holds a single year, so dates of another year are skipped
+        if date_col and current_date.year == start_date_obj.year:
+            date_cols.append(date_col)
+        current_date += timedelta(days=1)
+
+    employee_row = None
+    rows = set()
+    for row, row_values in enumerate(directory_rows[1:], start=2):
+        name = row_values[0] if row_values else ""
+        row_shift = row_values[1] if len(row_values) > 1 else ""
+        if name == employee_name and employee_row is None:
+            employee_row = row
+            rows.add(row)
+        elif row_shift == shift:
+            rows.add(row)
+
+    # Columns are planned in runs, so a request that only needs a few
+    # scattered columns never pulls the ones in between
+    ranges = []
+    for first_col, last_col in contiguous_runs(sorted(set(date_cols))):
+        for first_row, last_row in contiguous_runs(sorted(rows)):
+            ranges.append(f"{rowcol_to_a1(first_row, first_col)}:"
+                          f"{rowcol_to_a1(last_row, last_col)}")
+    if employee_row is not None:
+        ranges.append(rowcol_to_a1(employee_row, LEAVE_TAKEN_COL))
+    return ranges
+
+
+def fetch_request_grid(worksheet, employee_name, shift, start_date_obj,
+                       end_date_obj, lookback_days=LOOKBACK_DAYS):
+    """
+    Reads only the cells one leave request needs into a RequestGrid.
+
+    The header row and name/shift columns are read first, then every
+    planned range is read with a single batch_get, so the number of calls
+    is fixed and the payload grows with the booking, not with the sheet.
+    Cells outside the planned ranges are left empty in the grid.
+
+    Parameters:
+    - worksheet (gspread.Worksheet): The 'holiday' worksheet.
+    - employee_name (str): Name of the employee making the request.
+    - shift (str): The shift given with the request.
+    - start_date_obj (datetime): Start date of the request.
+    - end_date_obj (datetime): End date of the request.
+    - lookback_days (int): Days before the start date to include.
+
+    Returns:
+    - RequestGrid: A worksheet stand-in for the validators.
+    """
+    return fetch_batch_grid(
+        worksheet, [(employee_name, shift, start_date_obj, end_date_obj)],
+        lookback_days)
+
+
+def fetch_batch_grid(worksheet, requests, lookback_days=LOOKBACK_DAYS,
+                     grid_class=None):
+    """
+    Reads the cells needed by several leave requests into one grid.
+
+    Works like fetch_request_grid, but the planned ranges of every
+    request are merged and read with the same single batch_get.
+
+    Parameters:
+    - worksheet (gspread.Worksheet): The 'holiday' worksheet.
+    - requests (list): (employee_name, shift, start_date_obj,
+    end_date_obj) tuples.
+    - lookback_days (int): Days before each start date to include.
+    - grid_class (type): RequestGrid subclass to build (default is
+    RequestGrid).
+
+    Returns:
+    - RequestGrid: A worksheet stand-in for the validators.
+    """
+    header, directory_rows = fetch_roster_index(worksheet)
+    header_index = build_header_index([header])
+    values = [header] + [row[:2] for row in directory_rows[1:]]
+
+    ranges = []
+    for employee_name, shift, start_date_obj, end_date_obj in requests:
+        for a1_range in plan_request_ranges(
+                header_index, directory_rows, employee_name, shift,
+                start_date_obj, end_date_obj, lookback_days):
+            if a1_range not in ranges:
+                ranges.append(a1_range)
+    if ranges:
+        for a1_range, block in zip(ranges, worksheet.batch_get(ranges)):
+            grid_range = a1_range_to_grid_range(a1_range)
+            top = grid_range["startRowIndex"]
+            left = grid_range["startColumnIndex"]
+            for row_offset, block_row in enumerate(block):
+                row_values = values[top + row_offset]
+                width = left + len(block_row)
+                if len(row_values) < width:
+                    row_values.extend([""] * (width - len(row_values)))
+                row_values[left:width] = block_row
+
+    return (grid_class or RequestGrid)(worksheet, values, header_index)
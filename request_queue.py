@@ -0,0 +1,230 @@
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future
+from datetime import datetime
+
+from gspread.utils import rowcol_to_a1
+
+from range_planner import LEAVE_TAKEN_COL, RequestGrid
+from sites import current_site, use_site
+
+# Seconds the queue waits for more actions before flushing
+DEFAULT_WINDOW = 0.5
+
+PendingAction = namedtuple(
+    "PendingAction", "action employee_name shift start_date end_date")
+
+# An action to run, or to withdraw, and the positions of the submitted
+# actions it stands for
+CoalescedAction = namedtuple("CoalescedAction", "action sources")
+
+
+def _dates(action):
+    return (datetime.strptime(action.start_date, "%Y-%m-%d"),
+            datetime.strptime(action.end_date, "%Y-%m-%d"))
+
+
+def coalesce_actions(actions):
+    """
+    Drops the pending actions that would only repeat or undo another
+    action of the same employee before they are run.
+
+    For each employee, in submission order:
+    - an apply whose dates are the same as, or inside, those of the apply
+    right before it is a retry and is answered by that apply;
+    - an apply directly followed by a cancel covering all of its dates is
+    withdrawn, since the cancel would undo every cell it could write.
+
+    Every other action runs on its own, in submission order, so partly
+    overlapping or adjacent applies are judged separately; the overlay
+    grid removes any duplicate writes between them.
+
+    Parameters:
+    - actions (list): PendingAction tuples in submission order; names and
+    shifts are expected to be formatted already.
+
+    Returns:
+    - tuple: The CoalescedAction list to run, in the order of their first
+    submitted action, and the CoalescedAction list of withdrawn applies.
+    """
+    per_employee = {}
+    for position, action in enumerate(actions):
+        per_employee.setdefault(
+            (action.employee_name, action.shift), []).append(
+            CoalescedAction(action, [position]))
+
+    to_run, withdrawn = [], []
+    for sequence in per_employee.values():
+        merged = []
+        for item in sequence:
+            previous = merged[-1] if merged else None
+            if previous and previous.action.action == "apply":
+                prev_start, prev_end = _dates(previous.action)
+                start, end = _dates(item.action)
+                if (item.action.action == "apply"
+                        and start >= prev_start and end <= prev_end):
+                    merged[-1] = CoalescedAction(
+                        previous.action, previous.sources + item.sources)
+                    continue
+                if (item.action.action == "cancel"
+                        and start <= prev_start and end >= prev_end):
+                    withdrawn.append(merged.pop())
+            merged.append(item)
+        to_run.extend(merged)
+
+    to_run.sort(key=lambda item: item.sources[0])
+    return to_run, withdrawn
+
+
+class OverlayGrid(RequestGrid):
+    """
+    RequestGrid whose writes stay local until they are flushed.
+
+    The original values are kept so only the net changes are written,
+    and the 'Leave Taken' total is adjusted locally by the change in the
+    number of 'Leave' cells in the row, since the sheet's formula cannot
+    see writes that have not been sent yet.
+    """
+
+    def __init__(self, worksheet, values, header_index=None):
+        super().__init__(worksheet, values, header_index)
+        self.original = {}
+
+    def update_cell(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        row_values = self.values[row - 1]
+        while len(row_values) < col:
+            row_values.append("")
+        self.original.setdefault((row, col), row_values[col - 1])
+        row_values[col - 1] = value
+        self._dirty_rows.add(row)
+
+    def _refresh_dirty_rows(self):
+        for row in self._dirty_rows:
+            row_values = self.values[row - 1]
+            change = sum(
+                (row_values[col - 1] == "Leave") - (original == "Leave")
+                for (cell_row, col), original in self.original.items()
+                if cell_row == row
+            )
+            baseline = self.original.get(
+                (row, LEAVE_TAKEN_COL),
+                row_values[LEAVE_TAKEN_COL - 1]
+                if len(row_values) >= LEAVE_TAKEN_COL else "")
+            self.original.setdefault((row, LEAVE_TAKEN_COL), baseline)
+            try:
+                row_values[LEAVE_TAKEN_COL - 1] = str(int(baseline) + change)
+            except ValueError:
+                pass
+        self._dirty_rows.clear()
+
+    def changed_cells(self):
+        """
+        Returns every cell whose value differs from the original.
+
+        Returns:
+        - dict: (row, col) to the new value, including the 'Leave Taken'
+        totals worked out locally.
+        """
+        self._refresh_dirty_rows()
+        changed = {}
+        for (row, col), original in sorted(self.original.items()):
+            value = self.values[row - 1][col - 1]
+            if value != original:
+                changed[(row, col)] = value
+        return changed
+
+    def written_cells(self):
+        """
+        Returns the changed cells that have to be written to the sheet.
+
+        Returns:
+        - dict: (row, col) to the new value, without the 'Leave Taken'
+        column, which the sheet computes itself.
+        """
+        return {(row, col): value
+                for (row, col), value in self.changed_cells().items()
+                if col != LEAVE_TAKEN_COL}
+
+    def net_changes(self):
+        """
+        Returns the cells whose final value differs from the original.
+
+        Returns:
+        - list: Value ranges ready for Worksheet.batch_update, without the
+        'Leave Taken' column, which the sheet computes itself.
+        """
+        return [{"range": rowcol_to_a1(row, col), "values": [[value]]}
+                for (row, col), value in self.written_cells().items()]
+
+
+class LeaveRequestQueue:
+    """
+    Collects leave actions for a short window and flushes them together.
+
+    The first action submitted starts a timer; every action submitted
+    before it fires is handed to flush_batch in one call per site. submit()
+    returns a Future that resolves to whatever flush_batch reports for
+    that action.
+
+    Each action remembers the site it was submitted for, and flush_batch
+    runs with that site as the current site. Flushes for the same site run
+    one at a time, so two batches never validate against the same state.
+    """
+
+    def __init__(self, flush_batch, window=DEFAULT_WINDOW):
+        self.flush_batch = flush_batch
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+        self._flush_locks = defaultdict(threading.Lock)
+
+    def submit(self, action, employee_name, shift, start_date, end_date):
+        """
+        Queues an 'apply' or 'cancel' action for the current site.
+
+        Returns:
+        - Future: Resolves to the result of the action once flushed.
+        """
+        future = Future()
+        site = current_site()
+        with self._lock:
+            self._pending.append((site, PendingAction(
+                action, employee_name, shift, start_date, end_date), future))
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def flush(self):
+        """
+        Runs every pending action right away, as one batch per site.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        per_site = {}
+        for site, action, future in pending:
+            per_site.setdefault(site, []).append((action, future))
+        for site, site_pending in per_site.items():
+            with self._lock:
+                flush_lock = self._flush_locks[site.name]
+            with flush_lock, use_site(site):
+                self._flush_site(site_pending)
+
+    def _flush_site(self, pending):
+        actions = [action for action, _ in pending]
+        try:
+            results = self.flush_batch(actions)
+        except Exception as error:
+            for _, future in pending:
+                future.set_exception(error)
+            return
+        for (_, future), result in zip(pending, results):
+            future.set_result(result)
@@ -0,0 +1,361 @@
+import marshal
+import mmap
+import os
+import tempfile
+import threading
+from importlib.util import MAGIC_NUMBER
+
+from gspread.cell import Cell
+from gspread.utils import rowcol_to_a1
+
+# Location of the on-disk warm-start snapshot of the "holiday" worksheet
+SNAPSHOT_PATH = os.environ.get("HOLIDAY_SNAPSHOT", "roster.snapshot")
+
+# marshal output is only guaranteed to load in the interpreter that wrote
+# it, so the Python bytecode magic number is part of the file header
+SNAPSHOT_MAGIC = b"HBSNAP01" + MAGIC_NUMBER
+
+# Column holding each employee's 'Leave Taken' total, a sheet formula
+LEAVE_TAKEN_COL = 4
+
+
+def probe_freshness(worksheet):
+    """
+    Returns a cheap freshness token for the spreadsheet behind a worksheet.
+
+    Parameters:
+    - worksheet (gspread.Worksheet): The worksheet to probe.
+
+    Returns:
+    - str: The Drive 'modifiedTime' of the spreadsheet, which changes
+    whenever any cell in it is edited.
+    """
+    return worksheet.spreadsheet.get_lastUpdateTime()
+
+
+def site_snapshot_path(site_name, path=SNAPSHOT_PATH):
+    """
+    Derives the snapshot file of one site from the configured snapshot
+    path, e.g. 'roster.snapshot' becomes 'roster-north.snapshot'.
+
+    Parameters:
+    - site_name (str): Name of the site in sites.json.
+    - path (str): The configured snapshot path (HOLIDAY_SNAPSHOT).
+
+    Returns:
+    - str: The snapshot path for that site, in the same directory.
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}-{site_name}{extension}"
+
+
+def build_header_index(values):
+    """
+    Maps every header label in row 1 to its column number.
+
+    Parameters:
+    - values (list): The worksheet values as a list of rows.
+
+    Returns:
+    - dict: Header label (e.g. '04 Jan') to 1-based column number.
+    """
+    header_index = {}
+    if values:
+        for col, label in enumerate(values[0], start=1):
+            if label and label not in header_index:
+                header_index[label] = col
+    return header_index
+
+
+def build_employee_directory(values):
+    """
+    Maps every employee name to their row number and shift.
+
+    Parameters:
+    - values (list): The worksheet values as a list of rows.
+
+    Returns:
+    - dict: Employee name to a (1-based row number, shift) tuple.
+    """
+    employee_directory = {}
+    for row, row_values in enumerate(values[1:], start=2):
+        if not row_values or not row_values[0]:
+            continue
+        shift = row_values[1] if len(row_values) > 1 else ""
+        employee_directory.setdefault(row_values[0], (row, shift))
+    return employee_directory
+
+
+def read_snapshot(path=SNAPSHOT_PATH):
+    """
+    Loads a roster snapshot from disk through a read-only memory map.
+
+    Parameters:
+    - path (str): Location of the snapshot file.
+
+    Returns:
+    - dict: The snapshot payload, or None if the file is missing,
+    empty, written by another Python version or otherwise unreadable.
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            with mmap.mmap(snapshot_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                    return None
+                with memoryview(mapped) as view:
+                    payload = marshal.loads(view[len(SNAPSHOT_MAGIC):])
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def write_snapshot(payload, path=SNAPSHOT_PATH):
+    """
+    Atomically writes a roster snapshot to disk.
+
+    The payload is written to a temporary file next to the target and
+    then renamed over it, so a concurrent reader never sees a partial file.
+
+    Parameters:
+    - payload (dict): The snapshot payload to store.
+    - path (str): Location of the snapshot file.
+
+    Returns:
+    None
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(SNAPSHOT_MAGIC)
+            tmp_file.write(marshal.dumps(payload))
+        os.replace(tmp_path, path)
+    except OSError as error:
+        print(f"[DEBUG] Could not write roster snapshot: {error}")
+
+
+class LocalGrid:
+    """
+    In-memory copy of (part of) the 'holiday' worksheet.
+
+    It offers the subset of the gspread.Worksheet interface used by the
+    leave functions (col_values, row_values, find, update_cell), so it can
+    be passed anywhere a worksheet is expected. Reads are answered
+    locally; writes go straight through to the real worksheet and are
+    mirrored locally.
+    """
+
+    def __init__(self, worksheet, values, header_index=None):
+        self.worksheet = worksheet
+        self.values = [list(row) for row in values]
+        self.header_index = (header_index if header_index is not None
+                             else build_header_index(self.values))
+        self._dirty_rows = set()
+        # Guards local changes when one grid is shared between threads;
+        # calls to the Sheets API are made outside of it
+        self._lock = threading.RLock()
+
+    def _refresh_dirty_rows(self):
+        # 'Leave Taken' is a formula the sheet recalculates after a write,
+        # so that one cell of each row we have written to is re-read, in a
+        # single call, the next time it is needed
+        with self._lock:
+            rows = sorted(self._dirty_rows)
+            self._dirty_rows.clear()
+        if not rows:
+            return
+        blocks = self.worksheet.batch_get(
+            [rowcol_to_a1(row, LEAVE_TAKEN_COL) for row in rows])
+        with self._lock:
+            for row, block in zip(rows, blocks):
+                value = block[0][0] if block and block[0] else ""
+                self._set_cell(row, LEAVE_TAKEN_COL, value)
+
+    def _set_cell(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        row_values = self.values[row - 1]
+        while len(row_values) < col:
+            row_values.append("")
+        row_values[col - 1] = value
+
+    def col_values(self, col):
+        """
+        Returns the values of a column, trimmed like gspread's col_values.
+        """
+        if col == LEAVE_TAKEN_COL:
+            self._refresh_dirty_rows()
+        column = [row[col - 1] if len(row) >= col else ""
+                  for row in self.values]
+        while column and column[-1] == "":
+            column.pop()
+        return column
+
+    def row_values(self, row):
+        """
+        Returns the values of a row, trimmed like gspread's row_values.
+        """
+        self._refresh_dirty_rows()
+        if row > len(self.values):
+            return []
+        row_values = list(self.values[row - 1])
+        while row_values and row_values[-1] == "":
+            row_values.pop()
+        return row_values
+
+    def get_all_values(self):
+        """
+        Returns a copy of every row held in the grid.
+        """
+        self._refresh_dirty_rows()
+        return [list(row) for row in self.values]
+
+    def find(self, query):
+        """
+        Finds the first cell whose value equals the query.
+
+        Header labels are answered from the header index; anything else
+        falls back to a row-by-row scan, matching gspread's search order.
+        """
+        col = self.header_index.get(query)
+        if col is not None:
+            return Cell(1, col, query)
+        for row, row_values in enumerate(self.values, start=1):
+            for col, value in enumerate(row_values, start=1):
+                if value == query:
+                    return Cell(row, col, value)
+        return None
+
+    def update_cell(self, row, col, value):
+        """
+        Writes a cell to the worksheet and mirrors the change locally.
+        """
+        response = self.worksheet.update_cell(row, col, value)
+        with self._lock:
+            self._set_cell(row, col, value)
+            self._dirty_rows.add(row)
+        return response
+
+
+class CachedRoster(LocalGrid):
+    """
+    Full local copy of the 'holiday' worksheet, kept in step with the
+    spreadsheet through a freshness probe and persisted as a snapshot.
+    """
+
+    def __init__(self, worksheet, values, freshness, header_index=None,
+                 employee_directory=None, snapshot_path=SNAPSHOT_PATH):
+        super().__init__(worksheet, values, header_index)
+        self.freshness = freshness
+        self.employee_directory = (
+            employee_directory if employee_directory is not None
+            else build_employee_directory(self.values))
+        self.snapshot_path = snapshot_path
+
+    def is_fresh(self):
+        """
+        Checks the cache against the spreadsheet's freshness probe.
+
+        Returns:
+        - bool: True if nothing in the spreadsheet changed since the
+        cache was synced, False otherwise.
+        """
+        return probe_freshness(self.worksheet) == self.freshness
+
+    def ensure_fresh(self):
+        """
+        Re-syncs the cache if the spreadsheet changed since the last sync.
+        """
+        if not self.is_fresh():
+            self.sync()
+
+    def sync(self, freshness=None):
+        """
+        Pulls the whole worksheet in one call and saves a new snapshot.
+
+        The freshness token is taken before the read, so an edit landing
+        during the read leaves the cache marked stale rather than fresh.
+        """
+        if freshness is None:
+            freshness = probe_freshness(self.worksheet)
+        values = self.worksheet.get_all_values()
+        with self._lock:
+            self.freshness = freshness
+            self.values = values
+            self.header_index = build_header_index(values)
+            self.employee_directory = build_employee_directory(values)
+            self._dirty_rows.clear()
+            self.save()
+
+    def adopt_own_writes(self, cells):
+        """
+        Mirrors a request's own writes and keeps the cache fresh.
+
+        Our writes, audit rows included, move the spreadsheet's modified
+        time like anyone else's. Once they have all been made the time is
+        probed again and stored with the cells, and the snapshot is saved,
+        so the next request and the next session can still use the cache.
+
+        An edit by another session landing between the freshness check
+        before the request and this probe is taken for ours, so that
+        window is as long as one request. If Drive reports the new time
+        late, the cache just looks stale on the next probe.
+
+        Parameters:
+        - cells (dict): (row, col) to the value written, including the
+        'Leave Taken' totals worked out locally.
+
+        Returns:
+        None
+        """
+        freshness = probe_freshness(self.worksheet)
+        with self._lock:
+            for (row, col), value in cells.items():
+                self._set_cell(row, col, value)
+            self.freshness = freshness
+            self.save()
+
+    def save(self):
+        """
+        Writes the cache to the warm-start snapshot file.
+        """
+        write_snapshot({
+            "spreadsheet_id": self.worksheet.spreadsheet.id,
+            "worksheet_id": self.worksheet.id,
+            "freshness": self.freshness,
+            "values": self.values,
+            "header_index": self.header_index,
+            "employee_directory": self.employee_directory,
+        }, self.snapshot_path)
+
+
+def load_roster(worksheet, snapshot_path=SNAPSHOT_PATH):
+    """
+    Builds a CachedRoster, warm-starting from the snapshot when possible.
+
+    The snapshot is only used if it belongs to the same worksheet and its
+    freshness token still matches the spreadsheet; otherwise the whole
+    worksheet is synced once and a new snapshot is written.
+
+    Parameters:
+    - worksheet (gspread.Worksheet): The 'holiday' worksheet.
+    - snapshot_path (str): Location of the snapshot file.
+
+    Returns:
+    - CachedRoster: A roster ready to serve reads locally.
+    """
+    freshness = probe_freshness(worksheet)
+    snapshot = read_snapshot(snapshot_path)
+    if (snapshot
+            and snapshot.get("spreadsheet_id") == worksheet.spreadsheet.id
+            and snapshot.get("worksheet_id") == worksheet.id
+            and snapshot.get("freshness") == freshness):
+        return CachedRoster(
+            worksheet, snapshot["values"], freshness,
+            snapshot.get("header_index"), snapshot.get("employee_directory"),
+            snapshot_path)
+
+    roster = CachedRoster(worksheet, [], None, snapshot_path=snapshot_path)
+    roster.sync(freshness)
+    return roster
@@ -0,0 +1,319 @@
+import json
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# Rotation patterns and leave rules, see rules.json
+RULES_PATH = os.environ.get(
+    "HOLIDAY_RULES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"),
+)
+
+LeaveRequest = namedtuple(
+    "LeaveRequest", "employee_name shift start_date_obj end_date_obj")
+
+Denial = namedtuple("Denial", "rule remarks message")
+
+
+def parse_date(date_str):
+    """
+    Converts a 'YYYY-MM-DD' string from the rules config to a datetime.
+    """
+    return datetime.strptime(date_str, "%Y-%m-%d")
+
+
+class Rotation:
+    """
+    A repeating work pattern shared by one or more shifts.
+    """
+
+    def __init__(self, config):
+        self.shifts = list(config["shifts"])  # In rules.json order
+        self.base_date = parse_date(config["base_date"])
+        self.cycle_days = config["cycle_days"]
+        self.working_days = set(config["working_days"])
+
+    def is_due(self, date):
+        return (date - self.base_date).days % self.cycle_days \
+            in self.working_days
+
+
+class Day:
+    """
+    One date of the pass, shared by every request and rule visiting it.
+
+    The leave statuses for the date are read at most once, and only if a
+    rule asks for them, and the per-shift leave counts are memoised.
+    """
+
+    def __init__(self, sheet, date, shifts):
+        self.sheet = sheet
+        self.date = date
+        self.label = date.strftime("%d %b")
+        self.shifts = shifts
+        self._statuses = None
+        self._leave_counts = {}
+
+    @property
+    def statuses(self):
+        if self._statuses is None:
+            cell = self.sheet.find(self.label)
+            self._statuses = self.sheet.col_values(cell.col) if cell else []
+        return self._statuses
+
+    def status(self, row):
+        statuses = self.statuses
+        return statuses[row - 1] if row and len(statuses) >= row else ""
+
+    def leave_count(self, shift):
+        if shift not in self._leave_counts:
+            self._leave_counts[shift] = sum(
+                1 for i, status in enumerate(self.statuses)
+                if status == "Leave" and i < len(self.shifts)
+                and self.shifts[i] == shift
+            )
+        return self._leave_counts[shift]
+
+
+class Rule:
+    """
+    Base class for a rule declared in rules.json.
+
+    A rule keeps its own state per request, sees every date of the pass
+    through visit() and can deny the request from visit() or finish().
+    """
+
+    default_remarks = ""
+    lookback_days = 0
+
+    def __init__(self, config):
+        self.name = config.get("name", config["type"])
+        self.shifts = set(config.get("shifts", [])) or None
+        self.remarks = config.get("remarks", self.default_remarks)
+
+    def applies_to(self, shift):
+        return self.shifts is None or shift in self.shifts
+
+    def start(self, request, employee_row):
+        return {"employee_row": employee_row}
+
+    def visit(self, state, request, day, due):
+        return None
+
+    def finish(self, state, request):
+        return None
+
+    def deny(self, message):
+        return Denial(self.name, self.remarks, message)
+
+
+class ShiftCapRule(Rule):
+    """
+    Limits how many employees of a shift can be on leave on a workday.
+    """
+
+    default_remarks = "Exceeds shift leave cap"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_on_leave = config["max_on_leave"]
+        self.per_shift = config.get("per_shift", {})
+
+    def visit(self, state, request, day, due):
+        if not due or day.date < request.start_date_obj:
+            return None
+        cap = self.per_shift.get(request.shift, self.max_on_leave)
+        if day.leave_count(request.shift) >= cap:
+            return self.deny(
+                f"Leave request denied for {request.employee_name}: "
+                f"More than {cap} employees already on leave on "
+                f"{day.date.strftime('%Y-%m-%d')} within "
+                f"the {request.shift} shift.")
+        return None
+
+
+class StreakLimitRule(Rule):
+    """
+    Limits the run of consecutive workdays on leave, counting the leave
+    already booked right before the request and the new workdays in it.
+    """
+
+    default_remarks = "Exceeds consecutive workdays"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_workdays = config["max_workdays"]
+        self.lookback_days = config.get("lookback_days", self.max_workdays)
+
+    def start(self, request, employee_row):
+        state = super().start(request, employee_row)
+        state.update(streak=0, new_workdays=0)
+        return state
+
+    def visit(self, state, request, day, due):
+        if not due:
+            return None
+        if day.date < request.start_date_obj:
+            if day.status(state["employee_row"]) == "Leave":
+                state["streak"] += 1
+            else:
+                state["streak"] = 0
+        else:
+            state["new_workdays"] += 1
+        return None
+
+    def finish(self, state, request):
+        if state["streak"] + state["new_workdays"] > self.max_workdays:
+            return self.deny(
+                f"Leave request denied for {request.employee_name}: "
+                f"Exceeds {self.max_workdays} consecutive workdays.")
+        return None
+
+
+class BlackoutRule(Rule):
+    """
+    Refuses leave on workdays listed as blackout dates.
+    """
+
+    default_remarks = "Blackout Date"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.dates = {parse_date(date) for date in config.get("dates", [])}
+
+    def visit(self, state, request, day, due):
+        if due and day.date >= request.start_date_obj \
+                and day.date in self.dates:
+            return self.deny(
+                f"Leave request denied for {request.employee_name}: "
+                f"{day.date.strftime('%Y-%m-%d')} is a blackout date.")
+        return None
+
+
+RULE_TYPES = {
+    "shift_cap": ShiftCapRule,
+    "streak_limit": StreakLimitRule,
+    "blackout": BlackoutRule,
+}
+
+
+class RuleEngine:
+    """
+    Compiled rotations and rules, evaluated in a single pass over dates.
+    """
+
+    def __init__(self, config):
+        self.rotations = {}
+        for rotation_config in config.get("rotations", []):
+            rotation = Rotation(rotation_config)
+            for shift in rotation.shifts:
+                self.rotations[shift] = rotation
+        self.rules = []
+        for rule_config in config.get("rules", []):
+            try:
+                rule_type = RULE_TYPES[rule_config["type"]]
+            except KeyError:
+                raise ValueError(
+                    f"Unknown rule type: {rule_config.get('type')}")
+            self.rules.append(rule_type(rule_config))
+
+    @property
+    def lookback_days(self):
+        """
+        Days before a request's start date that some rule needs to see.
+        """
+        return max([rule.lookback_days for rule in self.rules] + [0])
+
+    def is_due(self, shift, date):
+        """
+        Checks whether a shift is due to work on a given date.
+        """
+        rotation = self.rotations.get(shift)
+        return rotation.is_due(date) if rotation else False
+
+    def evaluate(self, sheet, requests):
+        """
+        Evaluates one or more leave requests against every rule.
+
+        All requests are checked in one pass over the union of their date
+        ranges: each date's leave statuses are read at most once and
+        shared by every request and rule. Each request is judged against
+        the sheet as it is now, not against the other requests in the batch.
+
+        Parameters:
+        - sheet (gspread.Worksheet): The worksheet containing leave data,
+        or a local stand-in for it.
+        - requests (list): LeaveRequest tuples to evaluate.
+
+        Returns:
+        - list: For each request, the list of Denial tuples in rule
+        order; an empty list means the request passes every rule.
+        """
+        if not requests:
+            return []
+        employee_names = sheet.col_values(1)
+        shifts = sheet.col_values(2)
+
+        checks = []
+        for request in requests:
+            try:
+                employee_row = employee_names.index(request.employee_name) + 1
+            except ValueError:
+                employee_row = None
+            rules = [rule for rule in self.rules
+                     if rule.applies_to(request.shift)]
+            checks.append({
+                "request": request,
+                "first_date": request.start_date_obj
+                - timedelta(days=self.lookback_days),
+                "rules": [(rule, rule.start(request, employee_row))
+                          for rule in rules],
+                "denials": {},
+            })
+
+        current_date = min(check["first_date"] for check in checks)
+        last_date = max(request.end_date_obj for request in requests)
+        while current_date <= last_date:
+            day = Day(sheet, current_date, shifts)
+            for check in checks:
+                request = check["request"]
+                # The sheet holds a single year, so a look-back across
+                # New Year would land on the wrong end of it
+                if (current_date < check["first_date"]
+                        or current_date > request.end_date_obj
+                        or current_date.year
+                        != request.start_date_obj.year):
+                    continue
+                due = self.is_due(request.shift, current_date)
+                for position, (rule, state) in enumerate(check["rules"]):
+                    if position in check["denials"]:
+                        continue
+                    denial = rule.visit(state, request, day, due)
+                    if denial:
+                        check["denials"][position] = denial
+            current_date += timedelta(days=1)
+
+        results = []
+        for check in checks:
+            denials = []
+            for position, (rule, state) in enumerate(check["rules"]):
+                denial = (check["denials"].get(position)
+                          or rule.finish(state, check["request"]))
+                if denial:
+                    denials.append(denial)
+            results.append(denials)
+        return results
+
+
+def load_rules(path=RULES_PATH):
+    """
+    Loads and compiles the rotation patterns and rules from a JSON file.
+
+    Parameters:
+    - path (str): Location of the rules config.
+
+    Returns:
+    - RuleEngine: The compiled rules.
+    """
+    with open(path) as rules_file:
+        return RuleEngine(json.load(rules_file))
@@ -1,26 +1,40 @@
-import gspread
-from google.oauth2.service_account import Credentials
+import argparse
+import csv
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from range_planner import fetch_batch_grid, fetch_request_grid
+from request_queue import OverlayGrid, PendingAction, coalesce_actions
+from rules import LeaveRequest, load_rules
+from sites import current_site, load_sites, run_across_sites, set_default_site
 
-# Set up Google Sheets API connection
-SCOPE = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive",
-]
+# The "holiday" and "audit_trail" worksheets and the local roster of each
+# spreadsheet are opened on first use through current_site() (see sites.py)
 
-CREDS = Credentials.from_service_account_file("creds.json")
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open("holiday_book")
+# Shift rotations and leave rules (see rules.json)
+RULES = load_rules()
 
-# Get the "holiday" and "audit_trail" worksheets
-holiday = SHEET.worksheet("holiday")
-audit_trail = SHEET.worksheet("audit_trail")
+# Audit rows collected by buffered_audit_trail, per thread
+_audit_buffer = threading.local()
 
-# Define base dates for the start of the shift cycles (same for alignment)
-BASE_DATE_GREEN_RED = datetime.strptime("2024-01-04", "%Y-%m-%d")
-BASE_DATE_BLUE_YELLOW = BASE_DATE_GREEN_RED  # Consistent cycle alignment
+
+@contextmanager
+def buffered_audit_trail():
+    """
+    Collects audit rows logged on this thread instead of appending them
+    one by one, so a batch can write them with a single call.
+
+    Yields:
+    - list: The rows logged while the context is active.
+    """
+    rows = []
+    _audit_buffer.rows = rows
+    try:
+        yield rows
+    finally:
+        _audit_buffer.rows = None
 
 
 def log_to_audit_trail(employee_name, action, start_date, end_date,
@@ -43,7 +57,11 @@ def log_to_audit_trail(employee_name, action, start_date, end_date,
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     new_row = [timestamp, employee_name, action, start_date, end_date,
                status, remarks]
-    audit_trail.append_row(new_row)
+    buffered_rows = getattr(_audit_buffer, "rows", None)
+    if buffered_rows is not None:
+        buffered_rows.append(new_row)
+    else:
+        current_site().audit_trail.append_row(new_row)
     print(f"Logged action to audit_trail: {new_row}")
 
 
@@ -113,20 +131,7 @@ def is_employee_due_to_work(employee_shift, date):
     Returns:
     - bool: True if the employee is scheduled to work, False otherwise.
     """
-    if employee_shift in ["Red", "Green"]:
-        days_since_base = (date - BASE_DATE_GREEN_RED).days
-    elif employee_shift in ["Blue", "Yellow"]:
-        days_since_base = (date - BASE_DATE_BLUE_YELLOW).days
-    else:
-        return False
-
-    shift_cycle_day = days_since_base % 8  # 8-day shift cycle
-
-    if employee_shift in ["Red", "Green"]:
-        return shift_cycle_day < 4  # Work on days 0-3
-    elif employee_shift in ["Blue", "Yellow"]:
-        return shift_cycle_day >= 4  # Work on days 4-7
-    return False
+    return RULES.is_due(employee_shift, date)
 
 
 def format_input(input_value):
@@ -192,52 +197,11 @@ def validate_date(date_str):
         return None
 
 
-def calculate_consecutive_leave(sheet, employee_name, start_date_obj, shift):
-    """
-    Calculates the number of consecutive leave days an
-    employee has taken before the requested start date.
-
-    Parameters:
-    - sheet (gspread.Worksheet): The worksheet containing leave data.
-    - employee_name (str): Name of the employee.
-    - start_date_obj (datetime): The start date of the new leave request.
-    - shift (str): The shift type of the employee.
-
-    Returns:
-    - int: The number of consecutive leave days before the
-    requested start date.
-    """
-    date_columns = cache_date_columns(
-        sheet, start_date_obj - timedelta(days=8), start_date_obj
-    )
-    current_date = start_date_obj - timedelta(days=8)
-    employee_names = sheet.col_values(1)
-    shifts = sheet.col_values(2)
-
-    try:
-        employee_row = employee_names.index(employee_name) + 1
-    except ValueError:
-        return 0
-
-    consecutive_days = 0
-    while current_date < start_date_obj:
-        if is_employee_due_to_work(shift, current_date):
-            date_col = date_columns.get(current_date)
-            if date_col:
-                leave_statuses = sheet.col_values(date_col)
-                if leave_statuses[employee_row - 1] == "Leave":
-                    consecutive_days += 1
-                else:
-                    break
-        current_date += timedelta(days=1)
-    return consecutive_days
-
-
 def apply_leave(sheet, employee_name, start_date, end_date, shift):
     """
-    Applies leave for an employee, ensuring no more than 2 employees
-    are on leave within the same shift and that the cumulative
-    workdays do not exceed 8 consecutive days.
+    Applies leave for an employee if the request passes the rules in
+    rules.json, such as no more than 2 employees on leave within the
+    same shift and no more than 8 consecutive workdays of leave.
 
     Parameters:
     - sheet (gspread.Worksheet): The worksheet containing leave data.
@@ -257,12 +221,7 @@ def apply_leave(sheet, employee_name, start_date, end_date, shift):
 
     start_date_obj, end_date_obj = get_date_objects(start_date, end_date)
 
-    if not validate_workdays_limit(
-            sheet, employee_name, shift, start_date_obj, end_date_obj,
-            start_date, end_date):
-        return
-
-    if not validate_existing_leave_conflicts(
+    if not validate_leave_rules(
             sheet, employee_name, shift, start_date_obj, end_date_obj,
             start_date, end_date):
         return
@@ -316,11 +275,12 @@ def get_date_objects(start_date, end_date):
     return start_date_obj, end_date_obj
 
 
-def validate_workdays_limit(sheet, employee_name, shift, start_date_obj,
-                            end_date_obj, start_date, end_date):
+def validate_leave_rules(sheet, employee_name, shift, start_date_obj,
+                         end_date_obj, start_date, end_date):
     """
-    Validates if the new leave days along with consecutive days
-    exceed the limit.
+    Checks the leave request against every rule in rules.json, such as
+    the per-shift leave cap and the consecutive workdays limit, in a
+    single pass over the requested dates.
 
     Parameters:
     - sheet (gspread.Worksheet): The worksheet containing leave data.
@@ -332,75 +292,21 @@ def validate_workdays_limit(sheet, employee_name, shift, start_date_obj,
     - end_date (str): End date in 'YYYY-MM-DD' format.
 
     Returns:
-    - bool: True if the leave does not exceed the limit, False otherwise.
-    """
-    consecutive_leave_days = calculate_consecutive_leave(
-        sheet, employee_name, start_date_obj, shift
-    )
-    new_workdays = sum(
-        1 for d in (
-            start_date_obj + timedelta(days=i)
-            for i in range((end_date_obj - start_date_obj).days + 1)
-        ) if is_employee_due_to_work(shift, d)
-    )
-
-    if new_workdays + consecutive_leave_days > 8:
-        print(f"Leave request denied for {employee_name}: Exceeds "
-              f"8 consecutive workdays.")
+    - bool: True if every rule passes, False otherwise.
+    """
+    request = LeaveRequest(employee_name, shift, start_date_obj, end_date_obj)
+    denials = RULES.evaluate(sheet, [request])[0]
+    if denials:
+        for denial in denials:
+            print(denial.message)
         log_to_audit_trail(
-            employee_name, "Apply Leave", start_date, end_date,
-            "Denied", "Exceeds Consecutive 8 Days"
+            employee_name, "Apply Leave", start_date, end_date, "Denied",
+            "; ".join(denial.remarks for denial in denials)
         )
         return False
     return True
 
 
-def validate_existing_leave_conflicts(sheet, employee_name, shift,
-                                      start_date_obj, end_date_obj,
-                                      start_date, end_date):
-    """
-    Checks if there are already 2 employees on leave within the same shift.
-
-    Parameters:
-    - sheet (gspread.Worksheet): The worksheet containing leave data.
-    - employee_name (str): Name of the employee.
-    - shift (str): Employee's shift type.
-    - start_date_obj (datetime): Start date as a datetime object.
-    - end_date_obj (datetime): End date as a datetime object.
-    - start_date (str): Start date in 'YYYY-MM-DD' format.
-    - end_date (str): End date in 'YYYY-MM-DD' format.
-
-    Returns:
-    - bool: True if there is no conflict, False if conflict exists.
-    """
-    employee_names = sheet.col_values(1)
-    shifts = sheet.col_values(2)
-    date_columns = cache_date_columns(sheet, start_date_obj, end_date_obj)
-    current_date = start_date_obj
-
-    while current_date <= end_date_obj:
-        if is_employee_due_to_work(shift, current_date):
-            date_col = date_columns.get(current_date)
-            if date_col:
-                leave_statuses = sheet.col_values(date_col)
-                same_shift_leaves = [
-                    i for i, name in enumerate(employee_names)
-                    if leave_statuses[i] == "Leave" and shifts[i] == shift
-                ]
-                if len(same_shift_leaves) >= 2:
-                    print(f"Leave request denied for {employee_name}: "
-                          f"More than 2 employees already on leave on "
-                          f"{current_date.strftime('%Y-%m-%d')} within "
-                          f"the {shift} shift.")
-                    log_to_audit_trail(
-                        employee_name, "Apply Leave", start_date, end_date,
-                        "Denied", "Exceeds 2 employees on leave"
-                    )
-                    return False
-        current_date += timedelta(days=1)
-    return True
-
-
 def process_leave_application(sheet, employee_name, start_date_obj,
                               end_date_obj, shift, start_date, end_date):
     """
@@ -511,6 +417,129 @@ def cancel_leave(sheet, employee_name, start_date, end_date, shift):
                            "Approved", "")
 
 
+def sheet_for_request(employee_name, shift, start_date, end_date):
+    """
+    Picks the data source a single leave request is validated against.
+
+    The local roster is used while nobody else has changed the
+    spreadsheet since it was synced. Otherwise only the block of cells this request needs
+    is fetched, instead of re-reading the whole sheet.
+
+    Parameters:
+    - employee_name (str): Name of the employee as entered.
+    - shift (str): Shift type as entered.
+    - start_date (str): Start date in 'YYYY-MM-DD' format.
+    - end_date (str): End date in 'YYYY-MM-DD' format.
+
+    Returns:
+    - CachedRoster or RequestGrid: A worksheet stand-in for the request.
+    """
+    site = current_site()
+    if site.roster.is_fresh():
+        return site.roster
+    start_date_obj, end_date_obj = get_date_objects(start_date, end_date)
+    return fetch_request_grid(
+        site.holiday, format_input(employee_name), format_input(shift),
+        start_date_obj, end_date_obj, RULES.lookback_days)
+
+
+def run_leave_action(leave_action, employee_name, shift, start_date,
+                     end_date):
+    """
+    Runs apply_leave or cancel_leave against the freshest data available.
+
+    The action runs against a local overlay of that data, so the cells
+    it changes are written with one batch_update instead of a call per
+    day, followed by its audit rows with one append_rows.
+    When the action ran against the local roster, the roster takes on
+    its writes and stays fresh for the next request (see
+    CachedRoster.adopt_own_writes).
+
+    The resident service (service.py) replaces this function with one
+    that submits the action to its request queue.
+
+    Parameters:
+    - leave_action (function): apply_leave or cancel_leave.
+    - employee_name (str): Name of the employee as entered.
+    - shift (str): Shift type as entered.
+    - start_date (str): Start date in 'YYYY-MM-DD' format.
+    - end_date (str): End date in 'YYYY-MM-DD' format.
+
+    Returns:
+    - list: The audit rows logged for the action.
+    """
+    sheet = sheet_for_request(employee_name, shift, start_date, end_date)
+    overlay = OverlayGrid(sheet.worksheet, sheet.get_all_values(),
+                          sheet.header_index)
+    with buffered_audit_trail() as audit_rows:
+        leave_action(overlay, employee_name, start_date, end_date, shift)
+
+    site = current_site()
+    if overlay.written_cells():
+        sheet.worksheet.batch_update(overlay.net_changes())
+    if audit_rows:
+        site.audit_trail.append_rows(audit_rows)
+    if sheet is site.roster:
+        site.roster.adopt_own_writes(overlay.changed_cells())
+    return audit_rows
+
+
+def process_leave_batch(actions):
+    """
+    Runs a batch of leave actions with one read and deduplicated writes.
+
+    Actions are first coalesced per employee (see coalesce_actions). The
+    cells every remaining action needs are read with one batch_get, and
+    the actions run in order against a local overlay of those cells.
+    Only the net cell changes are then written with one batch_update,
+    followed by all audit rows with one append_rows.
+
+    Parameters:
+    - actions (list): PendingAction tuples in submission order.
+
+    Returns:
+    - list: For each submitted action, the audit rows logged for it.
+    """
+    actions = [action._replace(employee_name=format_input(
+        action.employee_name), shift=format_input(action.shift))
+        for action in actions]
+    to_run, withdrawn = coalesce_actions(actions)
+    results = [[] for _ in actions]
+    site = current_site()
+
+    overlay = fetch_batch_grid(
+        site.holiday,
+        [(item.action.employee_name, item.action.shift)
+         + get_date_objects(item.action.start_date, item.action.end_date)
+         for item in to_run],
+        RULES.lookback_days, OverlayGrid)
+
+    with buffered_audit_trail() as audit_rows:
+        for item in withdrawn:
+            log_to_audit_trail(
+                item.action.employee_name, "Apply Leave",
+                item.action.start_date, item.action.end_date, "Withdrawn",
+                "Cancelled before it was applied")
+            for source in item.sources:
+                results[source].append(audit_rows[-1])
+        for item in to_run:
+            logged = len(audit_rows)
+            leave_action = (apply_leave if item.action.action == "apply"
+                            else cancel_leave)
+            leave_action(overlay, item.action.employee_name,
+                         item.action.start_date, item.action.end_date,
+                         item.action.shift)
+            for source in item.sources:
+                results[source].extend(audit_rows[logged:])
+
+    changes = overlay.net_changes()
+    if changes:
+        site.holiday.batch_update(changes)
+    if audit_rows:
+        site.audit_trail.append_rows(audit_rows)
+    return results
+
+
 def request_leave():
     """
     CLI function to request leave by taking inputs from the user.
@@ -546,7 +575,7 @@ def request_leave():
             print(f"Error: The end date must be on or after the start date "
                   f"({start_date}).")
 
-    apply_leave(holiday, employee_name, start_date, end_date, shift)
+    run_leave_action(apply_leave, employee_name, shift, start_date, end_date)
 
 
 def request_leave_cancellation():
@@ -585,7 +614,7 @@ def request_leave_cancellation():
             print(f"Error: The end date must be on or after the start date "
                   f"({start_date}).")
 
-    cancel_leave(holiday, employee_name, start_date, end_date, shift)
+    run_leave_action(cancel_leave, employee_name, shift, start_date, end_date)
 
 
 def main():
@@ -633,5 +662,225 @@ def main():
             print("Invalid choice, try again.")
 
 
+def parse_args(argv=None):
+    """
+    Parses the command line options for run.py.
+
+    Without a command the interactive menu is started; the 'apply' and
+    'cancel' commands book or cancel a single leave request without
+    prompting, which is useful for scripting and profiling.
+
+    Parameters:
+    - argv (list): Arguments to parse (default is sys.argv[1:]).
+
+    Returns:
+    - argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(
+        description="Holiday Booking Application")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="run under the profiler and write a report and a "
+             "collapsed-stack file for flamegraph tools")
+    parser.add_argument(
+        "--profile-dir", default="profile",
+        help="directory for the profile output (default: profile)")
+    parser.add_argument(
+        "--profile-top", type=int, default=25,
+        help="number of functions in the top-N report (default: 25)")
+    parser.add_argument(
+        "--profile-deterministic", action="store_true",
+        help="also run cProfile and include its report")
+    parser.add_argument(
+        "--site",
+        help="site from sites.json to work on (default: the first one)")
+
+    commands = parser.add_subparsers(dest="command")
+    for command in ("apply", "cancel"):
+        command_parser = commands.add_parser(
+            command, help=f"{command} leave without the interactive menu")
+        command_parser.add_argument("employee_name")
+        command_parser.add_argument("shift")
+        command_parser.add_argument("start_date", help="YYYY-MM-DD")
+        command_parser.add_argument("end_date", help="YYYY-MM-DD")
+    batch_parser = commands.add_parser(
+        "batch", help="run a CSV file of leave actions as one batch")
+    batch_parser.add_argument(
+        "csv_file",
+        help="rows of [site,] action (apply/cancel), employee name, shift, "
+             "start date, end date; sites are processed concurrently")
+    commands.add_parser(
+        "report", help="summarise leave for every site in sites.json")
+    return parser.parse_args(argv)
+
+
+def read_batch_file(path):
+    """
+    Reads leave actions for the 'batch' command from a CSV file.
+
+    Each row may start with the name of a site from sites.json; rows
+    without one belong to the current site. Rows with an unknown site or
+    action, or with invalid dates, are reported and skipped.
+
+    Parameters:
+    - path (str): Location of the CSV file.
+
+    Returns:
+    - dict: Site name to its PendingAction tuples in file order.
+    """
+    sites = load_sites()
+    actions = {}
+    with open(path, newline="") as batch_file:
+        for line_number, row in enumerate(csv.reader(batch_file), start=1):
+            if not row or row[0].strip().startswith("#"):
+                continue
+            site_name = current_site().name
+            if len(row) == 6:
+                site_name = row.pop(0).strip()
+            if len(row) != 5 or row[0].strip().lower() not in (
+                    "apply", "cancel"):
+                print(f"Skipping line {line_number}: expected [site,] "
+                      f"action, employee name, shift, start date, end date.")
+                continue
+            if site_name not in sites:
+                print(f"Skipping line {line_number}: unknown site "
+                      f"{site_name}.")
+                continue
+            action, employee_name, shift, start_date, end_date = [
+                value.strip() for value in row]
+            start_date_obj = validate_date(start_date)
+            end_date_obj = validate_date(end_date)
+            if (not start_date_obj or not end_date_obj
+                    or end_date_obj < start_date_obj):
+                print(f"Skipping line {line_number}: invalid dates.")
+                continue
+            actions.setdefault(site_name, []).append(PendingAction(
+                action.lower(), employee_name, shift, start_date, end_date))
+    return actions
+
+
+def process_site_batches(actions):
+    """
+    Runs the batch of every site concurrently, one thread per site.
+
+    Parameters:
+    - actions (dict): Site name to its PendingAction tuples.
+
+    Returns:
+    - dict: Site name to a (results, error) tuple as returned by
+    run_across_sites.
+    """
+    sites = load_sites()
+    outcomes = run_across_sites(
+        lambda site: process_leave_batch(actions[site.name]),
+        [sites[name] for name in actions])
+    for name, (results, error) in outcomes.items():
+        if error:
+            print(f"[ERROR] Batch for {name} failed: {error}")
+        else:
+            statuses = Counter(row[5] for rows in results for row in rows)
+            print(f"{name}: {len(results)} actions, " + ", ".join(
+                f"{count} {status}" for status, count in
+                sorted(statuses.items())))
+    return outcomes
+
+
+def leave_report(site):
+    """
+    Summarises the leave booked in one site's roster.
+
+    Parameters:
+    - site (Site): The site to summarise.
+
+    Returns:
+    - dict: Shift name to a dict with the number of 'employees' and the
+    number of 'leave_days' booked.
+    """
+    roster = site.roster
+    roster.ensure_fresh()
+    report = {}
+    for row_values in roster.get_all_values()[1:]:
+        if len(row_values) < 2 or not row_values[0]:
+            continue
+        shift_report = report.setdefault(
+            row_values[1], {"employees": 0, "leave_days": 0})
+        shift_report["employees"] += 1
+        shift_report["leave_days"] += row_values.count("Leave")
+    return report
+
+
+def print_site_reports():
+    """
+    Builds the leave report of every site concurrently and prints them.
+
+    Returns:
+    None
+    """
+    totals = Counter()
+    for name, (report, error) in run_across_sites(leave_report).items():
+        print(f"\nSite: {name}")
+        if error:
+            print(f"  [ERROR] {error}")
+            continue
+        for shift, shift_report in sorted(report.items()):
+            print(f"  {shift:<10} {shift_report['employees']:>4} employees "
+                  f"{shift_report['leave_days']:>5} leave days")
+            totals["employees"] += shift_report["employees"]
+            totals["leave_days"] += shift_report["leave_days"]
+    print(f"\nAll sites: {totals['employees']} employees, "
+          f"{totals['leave_days']} leave days")
+
+
+def run_command(args):
+    """
+    Runs the interactive menu or the non-interactive command in args.
+
+    Parameters:
+    - args (argparse.Namespace): Options returned by parse_args.
+
+    Returns:
+    None
+    """
+    if args.site:
+        try:
+            set_default_site(args.site)
+        except KeyError:
+            print(f"Error: Unknown site {args.site}, see sites.json.")
+            return
+
+    if args.command is None:
+        current_site().open()
+        main()
+        return
+
+    if args.command == "batch":
+        process_site_batches(read_batch_file(args.csv_file))
+        return
+
+    if args.command == "report":
+        print_site_reports()
+        return
+
+    start_date_obj = validate_date(args.start_date)
+    end_date_obj = validate_date(args.end_date)
+    if not start_date_obj or not end_date_obj:
+        return
+    if end_date_obj < start_date_obj:
+        print(f"Error: The end date must be on or after the start date "
+              f"({args.start_date}).")
+        return
+
+    leave_action = apply_leave if args.command == "apply" else cancel_leave
+    run_leave_action(leave_action, args.employee_name, args.shift,
+                     args.start_date, args.end_date)
+
+
 if __name__ == "__main__":
-    main()
+    arguments = parse_args()
+    if arguments.profile:
+        from profiling import profile_call
+        profile_call(lambda: run_command(arguments), sys.modules[__name__],
+                     arguments.profile_dir, arguments.profile_top,
+                     arguments.profile_deterministic)
+    else:
+        run_command(arguments)
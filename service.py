@@ -0,0 +1,219 @@
+import codecs
+import functools
+import io
+import os
+import socket
+import sys
+import threading
+
+import run
+from request_queue import DEFAULT_WINDOW, LeaveRequestQueue
+from sites import current_site
+
+# Local socket the web terminal attaches to (see controllers/default.js)
+SOCKET_PATH = os.environ.get(
+    "HOLIDAY_SERVICE_SOCKET", "/tmp/holiday-booking.sock")
+
+# Seconds the service collects bookings from every session before running
+# them as one batch (see request_queue.LeaveRequestQueue)
+QUEUE_WINDOW = float(os.environ.get(
+    "HOLIDAY_SERVICE_WINDOW", str(DEFAULT_WINDOW)))
+
+
+class TerminalSession:
+    """
+    One web terminal attached over the local socket.
+
+    The browser sends raw keystrokes, as it would to a pty, so this class
+    provides the little line discipline the CLI needs: echo, backspace,
+    Enter and Ctrl-C/Ctrl-D, and CRLF line endings on output.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._pending = ""
+        self._write_lock = threading.Lock()
+
+    def write(self, data):
+        with self._write_lock:
+            self.connection.sendall(data.replace("\n", "\r\n").encode())
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def readline(self):
+        line = ""
+        while True:
+            if not self._pending:
+                chunk = self.connection.recv(1024)
+                if not chunk:
+                    return ""  # Connection closed: input() raises EOFError
+                self._pending = self._decoder.decode(chunk)
+            char, self._pending = self._pending[0], self._pending[1:]
+            if char in "\r\n":
+                if char == "\r" and self._pending.startswith("\n"):
+                    self._pending = self._pending[1:]
+                self.write("\n")
+                return line + "\n"
+            if char in "\x03\x04":
+                return ""
+            if char in "\x7f\b":
+                if line:
+                    line = line[:-1]
+                    self.write("\b \b")
+            elif char == "\x1b":
+                # Drop escape sequences such as arrow keys
+                self._pending = self._pending.lstrip("[O0123456789;")[1:]
+            elif char.isprintable():
+                line += char
+                self.write(char)
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+# Terminal session served by the current thread, if any
+_current = threading.local()
+
+
+def current_session():
+    """
+    Returns the terminal session served by this thread, or None.
+    """
+    return getattr(_current, "session", None)
+
+
+def attach_session(session):
+    """
+    Routes this thread's print() and input() to a terminal session.
+    """
+    _current.session = session
+
+
+def detach_session():
+    """
+    Routes this thread's print() and input() back to the real console.
+    """
+    _current.session = None
+
+
+class SessionStream:
+    """
+    Stands in for sys.stdin or sys.stdout and forwards each call to the
+    terminal session of the current thread, so print() and input() in
+    run.py reach the right browser.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def fileno(self):
+        if current_session() is not None:
+            # Makes input() use write/readline instead of the real console
+            raise io.UnsupportedOperation("fileno")
+        return self.fallback.fileno()
+
+    def __getattr__(self, name):
+        return getattr(current_session() or self.fallback, name)
+
+
+def queue_leave_action(queue, leave_action, employee_name, shift,
+                       start_date, end_date):
+    """
+    Runs a leave action through the service's request queue and reports
+    the outcome to the session that asked for it.
+
+    The action is validated and written together with the bookings other
+    sessions submitted in the same window, by process_leave_batch, so its
+    step-by-step messages go to the service log; the session is shown the
+    audit trail entries logged for it.
+
+    Parameters:
+    - queue (LeaveRequestQueue): The service's request queue.
+    - leave_action (function): apply_leave or cancel_leave.
+    - employee_name (str): Name of the employee as entered.
+    - shift (str): Shift type as entered.
+    - start_date (str): Start date in 'YYYY-MM-DD' format.
+    - end_date (str): End date in 'YYYY-MM-DD' format.
+
+    Returns:
+    None
+    """
+    action = "cancel" if leave_action is run.cancel_leave else "apply"
+    audit_rows = queue.submit(
+        action, employee_name, shift, start_date, end_date).result()
+    if not audit_rows:
+        print("No leave was found to cancel between "
+              f"{start_date} and {end_date}.")
+    for audit_row in audit_rows:
+        message = f"{audit_row[2]}: {audit_row[5]}"
+        if audit_row[6]:
+            message += f" ({audit_row[6]})"
+        print(message)
+        print(f"Logged action to audit_trail: {audit_row}")
+
+
+def serve_session(connection):
+    """
+    Runs the interactive menu for one terminal until it exits or hangs up.
+    """
+    session = TerminalSession(connection)
+    attach_session(session)
+    try:
+        run.main()
+    except (EOFError, OSError):
+        pass
+    except Exception as error:
+        print(f"[ERROR] {error}")
+    finally:
+        detach_session()
+        session.close()
+
+
+def serve(socket_path=SOCKET_PATH, window=QUEUE_WINDOW):
+    """
+    Starts the resident service and accepts terminal sessions forever.
+
+    Parameters:
+    - socket_path (str): Location of the local Unix socket.
+    - window (float): Seconds bookings are collected before each batch.
+
+    Returns:
+    None
+    """
+    # Connect before the first terminal attaches; the roster is never
+    # loaded, as each batch reads only the cells it needs
+    current_site().open()
+
+    sys.stdin = SessionStream(sys.stdin)
+    sys.stdout = SessionStream(sys.stdout)
+
+    queue = LeaveRequestQueue(run.process_leave_batch, window)
+    run.run_leave_action = functools.partial(queue_leave_action, queue)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    sys.__stdout__.write(f"Holiday booking service listening on "
+                         f"{socket_path}, batching bookings every {window}s\n")
+    sys.__stdout__.flush()
+    try:
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=serve_session, args=(connection,),
+                             daemon=True).start()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,291 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+
+import gspread
+from google.oauth2.service_account import Credentials
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+from roster_cache import load_roster, site_snapshot_path
+
+# Set up Google Sheets API connection
+SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive",
+]
+
+CREDS_PATH = "creds.json"
+
+# Registry of the spreadsheets to serve, one per site or department
+SITES_PATH = os.environ.get(
+    "HOLIDAY_SITES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "sites.json"),
+)
+
+# Used when there is no registry: the original single spreadsheet
+DEFAULT_SITES = [{"name": "holiday_book", "spreadsheet": "holiday_book"}]
+
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_BURST = 10
+
+# A request answered with a 429, a timeout or a server error is retried at
+# most this many times, waiting BACKOFF_SECONDS and then twice as long
+# before each further retry (1 + 2 + 4 + 8 + 16 seconds in all)
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1
+
+_credentials = None
+_credentials_lock = threading.Lock()
+
+
+def load_credentials():
+    """
+    Loads the service account credentials once and shares them.
+
+    Returns:
+    - Credentials: Scoped credentials for the Sheets and Drive APIs.
+    """
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = Credentials.from_service_account_file(
+                CREDS_PATH).with_scopes(SCOPE)
+        return _credentials
+
+
+class RateLimiter:
+    """
+    Token bucket allowing a number of API requests per minute, with
+    short bursts, shared by every thread working on one site.
+    """
+
+    def __init__(self, requests_per_minute, burst=DEFAULT_BURST):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens
+                                  + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error):
+    """
+    Checks whether a failed API request is worth sending again.
+
+    Parameters:
+    - error (gspread.exceptions.APIError): The error the request raised.
+
+    Returns:
+    - bool: True for rate limits (429, or the 403 'usageLimits' error of
+    the Drive API), timeouts and server errors, False otherwise.
+    """
+    if error.code == HTTPStatus.FORBIDDEN:
+        errors = error.error.get("errors") or [{}]
+        return errors[0].get("domain") == "usageLimits"
+    return (error.code in (HTTPStatus.REQUEST_TIMEOUT,
+                           HTTPStatus.TOO_MANY_REQUESTS)
+            or error.code >= HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
+class RateLimitedHTTPClient(HTTPClient):
+    """
+    gspread HTTP client that takes a token from its site's rate limiter
+    before every request, and retries a request that hit a rate limit or
+    a server error a bounded number of times with exponential backoff.
+
+    The retry count belongs to each call, so one client can be shared by
+    several threads, and a request that keeps failing raises its APIError
+    after MAX_RETRIES retries instead of being retried forever.
+    """
+
+    rate_limiter = None
+
+    def request(self, *args, **kwargs):
+        retries = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return super().request(*args, **kwargs)
+            except APIError as error:
+                if retries >= MAX_RETRIES or not is_retryable(error):
+                    raise
+            time.sleep(BACKOFF_SECONDS * 2 ** retries)
+            retries += 1
+
+
+class Site:
+    """
+    One holiday spreadsheet, with its own connection, rate-limit budget
+    and roster cache. Everything is opened on first use.
+    """
+
+    def __init__(self, name, spreadsheet, holiday_worksheet="holiday",
+                 audit_worksheet="audit_trail",
+                 requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                 burst=DEFAULT_BURST, snapshot=None):
+        self.name = name
+        self.spreadsheet_name = spreadsheet
+        self.holiday_worksheet = holiday_worksheet
+        self.audit_worksheet = audit_worksheet
+        self.rate_limiter = RateLimiter(requests_per_minute, burst)
+        self.snapshot_path = snapshot or site_snapshot_path(name)
+        self._opened = None
+        self._roster = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """
+        Connects to the spreadsheet and opens its worksheets, once.
+
+        Returns:
+        - dict: The opened 'holiday' and 'audit_trail' worksheets.
+        """
+        with self._lock:
+            if self._opened is None:
+                client = gspread.authorize(
+                    load_credentials(), http_client=RateLimitedHTTPClient)
+                client.http_client.rate_limiter = self.rate_limiter
+                sheet = client.open(self.spreadsheet_name)
+                self._opened = {
+                    "holiday": sheet.worksheet(self.holiday_worksheet),
+                    "audit_trail": sheet.worksheet(self.audit_worksheet),
+                }
+            return self._opened
+
+    @property
+    def holiday(self):
+        return self.open()["holiday"]
+
+    @property
+    def audit_trail(self):
+        return self.open()["audit_trail"]
+
+    @property
+    def roster(self):
+        """
+        The roster cache, loaded from the snapshot or the sheet the first
+        time it is needed, so commands that never read it (such as a
+        batch or the booking service) do not pay for it.
+        """
+        holiday = self.holiday
+        with self._lock:
+            if self._roster is None:
+                self._roster = load_roster(holiday, self.snapshot_path)
+            return self._roster
+
+
+_sites = None
+_default_site = None
+_current = threading.local()
+
+
+def load_sites(path=SITES_PATH):
+    """
+    Reads the site registry, falling back to the original spreadsheet.
+
+    Parameters:
+    - path (str): Location of the registry.
+
+    Returns:
+    - dict: Site name to Site, in registry order.
+    """
+    global _sites, _default_site
+    if _sites is None:
+        if os.path.exists(path):
+            with open(path) as sites_file:
+                configs = json.load(sites_file)["sites"]
+        else:
+            configs = DEFAULT_SITES
+        _sites = {config["name"]: Site(**config) for config in configs}
+        _default_site = next(iter(_sites.values()))
+    return _sites
+
+
+def set_default_site(name):
+    """
+    Chooses the site used by threads that are not working on another one.
+
+    Raises:
+    - KeyError: If no site has that name.
+    """
+    global _default_site
+    _default_site = load_sites()[name]
+
+
+def current_site():
+    """
+    Returns the site the current thread is working on.
+    """
+    load_sites()
+    return getattr(_current, "site", None) or _default_site
+
+
+@contextmanager
+def use_site(site):
+    """
+    Makes the current thread work on a site for the duration of a block.
+    """
+    previous = getattr(_current, "site", None)
+    _current.site = site
+    try:
+        yield site
+    finally:
+        _current.site = previous
+
+
+def run_across_sites(func, sites=None, max_workers=None):
+    """
+    Runs a function for several sites at once, one thread per site.
+
+    Inside func, current_site() returns the site being processed, so
+    everything in run.py reads from and writes to that site. Each site's
+    requests are limited by its own rate-limit budget, so the total time
+    is set by the slowest site rather than the sum of all of them.
+
+    Parameters:
+    - func (callable): Called with the Site for each site.
+    - sites (list): Sites to process (default is every registered site).
+    - max_workers (int): Maximum number of sites processed at once
+    (default is one thread per site).
+
+    Returns:
+    - dict: Site name to a (result, error) tuple; error is the exception
+    raised for that site, or None.
+    """
+    sites = list(sites if sites is not None else load_sites().values())
+    if not sites:
+        return {}
+
+    def process(site):
+        with use_site(site):
+            try:
+                return func(site), None
+            except Exception as error:
+                return None, error
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(sites),
+                            thread_name_prefix="site") as executor:
+        results = executor.map(process, sites)
+        return {site.name: result for site, result in zip(sites, results)}